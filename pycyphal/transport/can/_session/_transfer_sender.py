@@ -3,13 +3,32 @@
 # Author: Pavel Kirienko <pavel@opencyphal.org>
 
 import typing
+import asyncio
 import itertools
-import pycyphal
-from .._frame import CyphalFrame, TRANSFER_CRC_LENGTH_BYTES
+import functools
+from pycyphal.transport.commons import refragment
+from pycyphal.transport.commons.crc import CRC16CCITT
+from .._frame import CyphalFrame, TRANSFER_CRC_LENGTH_BYTES, TRANSFER_ID_MODULO
+from ..media import DataFrame, FrameFormat
 
 
+_T = typing.TypeVar("_T")
+
 _PADDING_PATTERN = b"\x00"
 
+# CAN FD length quantization bounds both the frame size and the padding, so the padding requirement for every
+# possible data length and all possible padding blocks can be computed once at import time.
+_REQUIRED_PADDING_BY_LENGTH = tuple(map(CyphalFrame.get_required_padding, range(64)))
+_PADDING_BY_LENGTH = tuple(memoryview(_PADDING_PATTERN * n) for n in range(max(_REQUIRED_PADDING_BY_LENGTH) + 1))
+
+# Payloads up to this size that arrive in several fragments are flattened into one contiguous buffer,
+# as the per-fragment overheads of CRC update and refragmentation exceed the cost of one small copy.
+_CONSOLIDATION_THRESHOLD_BYTES = 512
+
+# Transfers larger than this (hundreds of CAN FD frames) take long enough to serialize to cause a noticeable
+# event loop stall, so serialize_transfer_async() moves them into the thread pool.
+_OFFLOAD_THRESHOLD_BYTES = 16 * 1024
+
 
 def serialize_transfer(
     compiled_identifier: int,
@@ -21,28 +40,103 @@ def serialize_transfer(
     We never request loopback for the whole transfer since it doesn't make sense. Instead, loopback request is
     always limited to the first frame only since it's sufficient for timestamping purposes.
     """
+    return _serialize_transfer(
+        functools.partial(CyphalFrame, identifier=compiled_identifier, transfer_id=transfer_id),
+        fragmented_payload,
+        max_frame_payload_bytes,
+    )
+
+
+def serialize_transfer_compiled(
+    compiled_identifier: int,
+    transfer_id: int,
+    fragmented_payload: typing.Sequence[memoryview],
+    max_frame_payload_bytes: int,
+) -> typing.Iterable[DataFrame]:
+    """
+    Like :func:`serialize_transfer`, but yields ready-to-transmit media-layer frames directly, bypassing the
+    intermediate :class:`CyphalFrame` instances. This is a fast path for callers that do not need the
+    unpacked frame representation; it halves the number of objects constructed per frame.
+    """
+    base_tail = transfer_id % TRANSFER_ID_MODULO
+
+    def make_frame(
+        padded_payload: memoryview, start_of_transfer: bool, end_of_transfer: bool, toggle_bit: bool
+    ) -> DataFrame:
+        tail = base_tail
+        if start_of_transfer:
+            tail |= 1 << 7
+        if end_of_transfer:
+            tail |= 1 << 6
+        if toggle_bit:
+            tail |= 1 << 5
+        data = bytearray(padded_payload)
+        data.append(tail)
+        return DataFrame(FrameFormat.EXTENDED, compiled_identifier, data)
+
+    return _serialize_transfer(make_frame, fragmented_payload, max_frame_payload_bytes)
+
+
+async def serialize_transfer_async(
+    compiled_identifier: int,
+    transfer_id: int,
+    fragmented_payload: typing.Sequence[memoryview],
+    max_frame_payload_bytes: int,
+) -> typing.List[CyphalFrame]:
+    """
+    Like :func:`serialize_transfer`, but large transfers are serialized in the default thread pool executor
+    so that the event loop remains responsive while hundreds of frames are being prepared.
+    Small transfers are serialized synchronously because for them the offloading overhead would dominate.
+    """
+
+    def once() -> typing.List[CyphalFrame]:
+        return list(
+            serialize_transfer(
+                compiled_identifier=compiled_identifier,
+                transfer_id=transfer_id,
+                fragmented_payload=fragmented_payload,
+                max_frame_payload_bytes=max_frame_payload_bytes,
+            )
+        )
+
+    payload_length = 0
+    for frag in fragmented_payload:
+        payload_length += len(frag)
+    if payload_length > _OFFLOAD_THRESHOLD_BYTES:
+        return await asyncio.get_running_loop().run_in_executor(None, once)
+    return once()
+
+
+def _serialize_transfer(
+    make_frame: typing.Callable[..., _T],
+    fragmented_payload: typing.Sequence[memoryview],
+    max_frame_payload_bytes: int,
+) -> typing.Iterator[_T]:
     if max_frame_payload_bytes < 1:  # pragma: no cover
         raise ValueError(f"Invalid max payload: {max_frame_payload_bytes}")
 
-    payload_length = sum(map(len, fragmented_payload))
+    payload_length = 0
+    for frag in fragmented_payload:
+        payload_length += len(frag)
+
+    if len(fragmented_payload) > 1 and payload_length <= _CONSOLIDATION_THRESHOLD_BYTES:
+        fragmented_payload = (memoryview(b"".join(fragmented_payload)),)
 
     if payload_length <= max_frame_payload_bytes:  # SINGLE-FRAME TRANSFER
         if payload_length > 0:
-            padding_length = CyphalFrame.get_required_padding(payload_length)
-            refragmented = pycyphal.transport.commons.refragment(
-                itertools.chain(fragmented_payload, (memoryview(_PADDING_PATTERN * padding_length),)),
+            padding_length = _REQUIRED_PADDING_BY_LENGTH[payload_length]
+            refragmented = refragment(
+                itertools.chain.from_iterable((fragmented_payload, (_PADDING_BY_LENGTH[padding_length],))),
                 max_frame_payload_bytes,
             )
-            (payload,) = tuple(refragmented)
+            payload = next(iter(refragmented))
         else:
             # The special case is necessary because refragment() yields nothing if the payload is empty
             payload = memoryview(b"")
 
         assert max_frame_payload_bytes >= len(payload) >= payload_length
-        yield CyphalFrame(
-            identifier=compiled_identifier,
+        yield make_frame(
             padded_payload=payload,
-            transfer_id=transfer_id,
             start_of_transfer=True,
             end_of_transfer=True,
             toggle_bit=True,
@@ -51,28 +145,47 @@ def serialize_transfer(
         # Compute padding
         last_frame_payload_length = payload_length % max_frame_payload_bytes
         if last_frame_payload_length + TRANSFER_CRC_LENGTH_BYTES >= max_frame_payload_bytes:
-            padding = b""
+            padding_length = 0
         else:
             last_frame_data_length = last_frame_payload_length + TRANSFER_CRC_LENGTH_BYTES
-            padding = _PADDING_PATTERN * CyphalFrame.get_required_padding(last_frame_data_length)
+            padding_length = _REQUIRED_PADDING_BY_LENGTH[last_frame_data_length]
 
-        # Fragment generator that goes over the padding and CRC also
-        crc_bytes = pycyphal.transport.commons.crc.CRC16CCITT.new(*fragmented_payload, padding).value_as_bytes
-        refragmented = pycyphal.transport.commons.refragment(
-            itertools.chain(fragmented_payload, (memoryview(padding + crc_bytes),)), max_frame_payload_bytes
-        )
+        # Fragment generator that goes over the padding and CRC also.
+        # The CRC is updated as each fragment is handed over for refragmentation, so the payload is traversed
+        # only once; by the time the trailing chunk is requested the final CRC value is already known.
+        # The trailing chunk is a single preallocated buffer whose zero-initialized prefix doubles as the padding.
+        def fused() -> typing.Iterator[memoryview]:
+            crc = CRC16CCITT()
+            for frag in fragmented_payload:
+                crc.add(frag)
+                yield frag
+            trailing = bytearray(padding_length + TRANSFER_CRC_LENGTH_BYTES)
+            crc.add(memoryview(trailing)[:padding_length])
+            trailing[padding_length:] = crc.value_as_bytes
+            yield memoryview(trailing)
 
-        # Serialized frame emission
-        for index, (last, frag) in enumerate(pycyphal.util.mark_last(refragmented)):
-            first = index == 0
-            yield CyphalFrame(
-                identifier=compiled_identifier,
-                padded_payload=frag,
-                transfer_id=transfer_id,
-                start_of_transfer=first,
-                end_of_transfer=last,
-                toggle_bit=index % 2 == 0,
+        refragmented = refragment(fused(), max_frame_payload_bytes)
+
+        # Serialized frame emission. The refragmented stream is consumed with a one-item look-ahead instead of
+        # mark_last() to keep the tight loop free of the extra generator layer and per-item tuple.
+        it = iter(refragmented)
+        prev = next(it)  # A multi-frame transfer always contains at least two frames.
+        index = 0
+        for frag in it:
+            yield make_frame(
+                padded_payload=prev,
+                start_of_transfer=index == 0,
+                end_of_transfer=False,
+                toggle_bit=(index & 1) == 0,
             )
+            prev = frag
+            index += 1
+        yield make_frame(
+            padded_payload=prev,
+            start_of_transfer=index == 0,
+            end_of_transfer=True,
+            toggle_bit=(index & 1) == 0,
+        )
 
 
 def _unittest_can_serialize_transfer() -> None:
@@ -108,13 +221,25 @@ def _unittest_can_serialize_transfer() -> None:
         fragmented_payload: typing.Sequence[memoryview],
         max_frame_payload_bytes: int,
     ) -> typing.Iterable[DataFrame]:
-        for f in serialize_transfer(
-            compiled_identifier=compiled_identifier,
-            transfer_id=transfer_id,
-            fragmented_payload=fragmented_payload,
-            max_frame_payload_bytes=max_frame_payload_bytes,
-        ):
-            yield f.compile()
+        out = [
+            f.compile()
+            for f in serialize_transfer(
+                compiled_identifier=compiled_identifier,
+                transfer_id=transfer_id,
+                fragmented_payload=fragmented_payload,
+                max_frame_payload_bytes=max_frame_payload_bytes,
+            )
+        ]
+        # The fast path shall produce exactly the same frames.
+        assert out == list(
+            serialize_transfer_compiled(
+                compiled_identifier=compiled_identifier,
+                transfer_id=transfer_id,
+                fragmented_payload=fragmented_payload,
+                max_frame_payload_bytes=max_frame_payload_bytes,
+            )
+        )
+        return out
 
     def one(items: typing.Iterable[meta]) -> meta:
         (out,) = list(items)
@@ -126,7 +251,7 @@ def _unittest_can_serialize_transfer() -> None:
         run(0xBADC0FE, 32 + 19, [mv(bytes(range(60)))], 63)
     )
 
-    crc = pycyphal.transport.commons.crc.CRC16CCITT()
+    crc = CRC16CCITT()
     crc.add(bytes(range(0x1E)))
     assert crc.value == 0x3554
     assert [
@@ -137,7 +262,7 @@ def _unittest_can_serialize_transfer() -> None:
         mkf(0xBADC0FE, b"\x1c\x1d\x35\x54", 19, False, True, True),
     ] == list(run(0xBADC0FE, 323219, [mv(bytes(range(0x1E)))], 7))
 
-    crc = pycyphal.transport.commons.crc.CRC16CCITT()
+    crc = CRC16CCITT()
     crc.add(bytes(range(0x1D)))
     assert crc.value == 0xC46F
     assert [
@@ -146,7 +271,7 @@ def _unittest_can_serialize_transfer() -> None:
         mkf(123456, b"\x6f", 19, False, True, True),
     ] == list(run(123456, 32323219, [mv(bytes(range(0x1D)))], 15))
 
-    crc = pycyphal.transport.commons.crc.CRC16CCITT()
+    crc = CRC16CCITT()
     crc.add(bytes(range(0x1E)) + b"\x00")
     assert crc.value == 0x32F6
     assert [
@@ -154,3 +279,23 @@ def _unittest_can_serialize_transfer() -> None:
         mkf(123456, b"\x0b\x0c\x0d\x0e\x0f\x10\x11\x12\x13\x14\x15", 19, False, False, False),
         mkf(123456, b"\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x00\x32\xf6", 19, False, True, True),
     ] == list(run(123456, 32323219, [mv(bytes(range(0x1E)))], 11))
+
+
+async def _unittest_can_serialize_transfer_async() -> None:
+    mv = memoryview
+    small = [mv(b"Hello world!")]
+    large = [mv(bytes(range(256)) * 256)]  # 64 KiB -- large enough to be offloaded to the thread pool.
+    for fragmented_payload in (small, large):
+        assert list(
+            serialize_transfer(
+                compiled_identifier=0xBADC0FE,
+                transfer_id=19,
+                fragmented_payload=fragmented_payload,
+                max_frame_payload_bytes=63,
+            )
+        ) == await serialize_transfer_async(
+            compiled_identifier=0xBADC0FE,
+            transfer_id=19,
+            fragmented_payload=fragmented_payload,
+            max_frame_payload_bytes=63,
+        )